@@ -1,7 +1,8 @@
-import pymysql
+import mysql.connector
+from mysql.connector import pooling
 import random
 import time
-import json
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 # Database connection details
@@ -10,66 +11,157 @@ DB_USER = 'admin'
 DB_PASSWORD = 'xxxxxxxx'
 DB_NAME = 'demodb'
 
+DB_PARAMS = {
+    'host': DB_HOST,
+    'user': DB_USER,
+    'password': DB_PASSWORD,
+    'database': DB_NAME
+}
+
 # Constants
 NUM_THREADS = 10
 MAX_ID = 5_000_000
+BATCH_SIZE = 100
 
-# Function to update a single row with full JSON update
-def update_row(connection):
-    try:
-        with connection.cursor() as cursor:
-            random_id = random.randint(1, MAX_ID)
+# Lock wait timeout / deadlock: back off and retry instead of failing the batch
+RETRYABLE_ERRNOS = (1205, 1213)
+BACKOFF_BASE = 0.001
+BACKOFF_MAX = 0.2
+BACKOFF_MAX_EXPONENT = 8  # 2 ** 8 * BACKOFF_BASE already exceeds BACKOFF_MAX
+
+# Errors after which the thread's connection is dropped and rebuilt
+CONNECTION_ERRORS = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)
+
+CREATE_BATCH_TABLE_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS fight_batch (
+    id INT PRIMARY KEY,
+    resource INT NOT NULL,
+    energy INT NOT NULL
+)
+"""
 
-            # First, fetch the current player_data
-            select_sql = "SELECT player_data FROM fight WHERE id = %s"
-            cursor.execute(select_sql, (random_id,))
-            result = cursor.fetchone()
+# Fixed-shape statements, prepared once per cursor and then only re-bound
+DELETE_BATCH_SQL = "DELETE FROM fight_batch"
 
-            if result:
-                current_data = json.loads(result['player_data'])
+INSERT_BATCH_SQL = (
+    "INSERT INTO fight_batch (id, resource, energy) VALUES "
+    + ", ".join(["(%s, %s, %s)"] * BATCH_SIZE)
+)
 
-                # Update the specific fields
-                current_data['resource'] = random.randint(100, 10000)
-                current_data['energy'] = random.randint(10, 100)
+UPDATE_BATCH_SQL = """
+UPDATE fight f
+JOIN fight_batch t ON f.id = t.id
+SET f.player_data = JSON_SET(
+    f.player_data,
+    '$.resource', t.resource,
+    '$.energy', t.energy
+)
+"""
 
-                # Convert back to JSON string
-                new_player_data = json.dumps(current_data)
+# Shared pool so threads borrow connections instead of dialing their own
+pool = pooling.MySQLConnectionPool(
+    pool_name='fight_pool',
+    pool_size=NUM_THREADS * 2,
+    **DB_PARAMS
+)
 
-                # Update the row with the new JSON data
-                update_sql = "UPDATE fight SET player_data = %s WHERE id = %s"
-                cursor.execute(update_sql, (new_player_data, random_id))
+# Per-thread connection and prepared cursors, built lazily from the pool
+tls = threading.local()
 
-                connection.commit()
-                return True
-            else:
-                return False
+# Function to get this thread's connection, (re)building it on first use
+def get_conn():
+    if getattr(tls, 'conn', None) is None:
+        connection = pool.get_connection()
+        try:
+            # Session-scoped staging table for the batched updates
+            cursor = connection.cursor()
+            cursor.execute(CREATE_BATCH_TABLE_SQL)
+            cursor.close()
+
+            # One prepared cursor per statement keeps each one prepared server-side
+            tls.cursors = tuple(connection.cursor(prepared=True) for _ in range(3))
+        except Exception:
+            # Hand the connection back to the pool instead of leaking it
+            try:
+                connection.close()
+            except Exception:
+                pass
+            raise
+        tls.conn = connection
+    return tls.conn, tls.cursors
+
+# Function to drop this thread's connection so the next call reconnects
+def reset_conn():
+    connection = tls.conn
+    tls.conn = None
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+# Function to update a batch of rows with one JOIN-based JSON update
+def update_row():
+    connection = None
+    try:
+        connection, (delete_cursor, insert_cursor, update_cursor) = get_conn()
+        # Unique ids so the batch table primary key never collides
+        ids = random.sample(range(1, MAX_ID + 1), BATCH_SIZE)
+        params = []
+        for random_id in ids:
+            params.extend((random_id, random.randint(100, 10000), random.randint(10, 100)))
+
+        delete_cursor.execute(DELETE_BATCH_SQL)
+        insert_cursor.execute(INSERT_BATCH_SQL, params)
+        update_cursor.execute(UPDATE_BATCH_SQL)
+        connection.commit()
+        return BATCH_SIZE
     except Exception as e:
-        print(f"Error updating row: {e}")
+        if connection is None:
+            # get_conn failed and has already returned the connection to the pool
+            raise
+        if isinstance(e, CONNECTION_ERRORS) and e.errno not in RETRYABLE_ERRNOS:
+            # Connection-level failure: rebuild it on the next batch
+            print(f"Connection lost, reconnecting: {e}")
+            reset_conn()
+            return 0
         connection.rollback()
-        return False
+        if isinstance(e, mysql.connector.Error) and e.errno in RETRYABLE_ERRNOS:
+            raise
+        print(f"Error updating rows: {e}")
+        return 0
+
+# Function to get the backoff delay after a number of consecutive failures
+def backoff_delay(attempt):
+    # Clamp the exponent so a long outage never overflows the float conversion
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** min(attempt, BACKOFF_MAX_EXPONENT))
 
 # Function to be executed by each thread
 def thread_task(thread_id):
-    connection = pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME,
-        cursorclass=pymysql.cursors.DictCursor
-    )
-
     try:
         updates_count = 0
+        attempt = 0
         while True:
-            if update_row(connection):
-                updates_count += 1
-                if updates_count % 100 == 0:
-                    print(f"Thread {thread_id}: Updated {updates_count} rows")
-            time.sleep(0.01)  # Small delay to prevent overwhelming the database
+            try:
+                updated = update_row()
+            except mysql.connector.errors.PoolError:
+                # An exhausted pool is not contention; stop instead of backing off forever
+                raise
+            except mysql.connector.Error:
+                # Contention or a lost connection: back off; reset once a batch lands
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            if not updated:
+                # Persistent errors (e.g. a missing table) back off as well instead of spinning
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            attempt = 0
+            updates_count += updated
+            if updates_count % 1000 == 0:
+                print(f"Thread {thread_id}: Updated {updates_count} rows")
     except Exception as e:
         print(f"An error occurred in thread {thread_id}: {e}")
-    finally:
-        connection.close()
 
 # Main execution
 def main():
@@ -1,6 +1,8 @@
-import pymysql
+import mysql.connector
+from mysql.connector import pooling
 import random
 import time
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 # Database connection details
@@ -9,57 +11,188 @@ DB_USER = 'admin'
 DB_PASSWORD = 'xxxxxxxx'
 DB_NAME = 'demodb'
 
+DB_PARAMS = {
+    'host': DB_HOST,
+    'user': DB_USER,
+    'password': DB_PASSWORD,
+    'database': DB_NAME
+}
+
 # Constants
 NUM_THREADS = 10
 MAX_ID = 5_000_000
 
-# Function to update a single row with partial JSON update
-def update_row(connection):
+# Pending updates are coalesced per id and flushed on size or age
+FLUSH_ROWS = 256
+FLUSH_INTERVAL = 0.05
+
+# Lock wait timeout / deadlock: back off and retry instead of failing the batch
+RETRYABLE_ERRNOS = (1205, 1213)
+BACKOFF_BASE = 0.001
+BACKOFF_MAX = 0.2
+BACKOFF_MAX_EXPONENT = 8  # 2 ** 8 * BACKOFF_BASE already exceeds BACKOFF_MAX
+
+# Errors after which the thread's connection is dropped and rebuilt
+CONNECTION_ERRORS = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)
+
+CREATE_BATCH_TABLE_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS fight_batch (
+    id INT PRIMARY KEY,
+    resource INT NOT NULL,
+    energy INT NOT NULL
+)
+"""
+
+# Statements prepared once per cursor and then only re-bound
+DELETE_BATCH_SQL = "DELETE FROM fight_batch"
+
+UPDATE_BATCH_SQL = """
+UPDATE fight f
+JOIN fight_batch t ON f.id = t.id
+SET f.player_data = JSON_SET(
+    f.player_data,
+    '$.resource', t.resource,
+    '$.energy', t.energy
+)
+"""
+
+# Shared pool so threads borrow connections instead of dialing their own
+pool = pooling.MySQLConnectionPool(
+    pool_name='fight_pool',
+    pool_size=NUM_THREADS * 2,
+    **DB_PARAMS
+)
+
+# Per-thread connection and prepared cursors, built lazily from the pool
+tls = threading.local()
+
+# Function to get this thread's connection, (re)building it on first use
+def get_conn():
+    if getattr(tls, 'conn', None) is None:
+        connection = pool.get_connection()
+        try:
+            # Session-scoped staging table for the batched updates
+            cursor = connection.cursor()
+            cursor.execute(CREATE_BATCH_TABLE_SQL)
+            cursor.close()
+
+            # One prepared cursor per statement keeps each one prepared server-side;
+            # the INSERT gets one per batch size since its placeholder count varies
+            tls.cursors = (connection.cursor(prepared=True), {}, connection.cursor(prepared=True))
+        except Exception:
+            # Hand the connection back to the pool instead of leaking it
+            try:
+                connection.close()
+            except Exception:
+                pass
+            raise
+        tls.conn = connection
+    return tls.conn, tls.cursors
+
+# Function to drop this thread's connection so the next call reconnects
+def reset_conn():
+    connection = tls.conn
+    tls.conn = None
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+# Function to get the prepared multi-row INSERT for a given number of rows
+# (a batch never exceeds FLUSH_ROWS, which bounds the cache)
+def insert_cursor_for(connection, insert_cursors, rows):
+    if rows not in insert_cursors:
+        sql = (
+            "INSERT INTO fight_batch (id, resource, energy) VALUES "
+            + ", ".join(["(%s, %s, %s)"] * rows)
+        )
+        insert_cursors[rows] = (sql, connection.cursor(prepared=True))
+    return insert_cursors[rows]
+
+# Function to flush the pending per-id updates with one JOIN-based JSON update
+def update_row(pending):
+    connection = None
     try:
-        with connection.cursor() as cursor:
-            random_id = random.randint(1, MAX_ID)
-            new_resource = random.randint(100, 10000)
-            new_energy = random.randint(10, 100)
-
-            sql = """
-            UPDATE fight
-            SET player_data = JSON_SET(
-                player_data,
-                '$.resource', %s,
-                '$.energy', %s
-            )
-            WHERE id = %s
-            """
-            cursor.execute(sql, (new_resource, new_energy, random_id))
+        connection, (delete_cursor, insert_cursors, update_cursor) = get_conn()
+        params = []
+        for random_id, (new_resource, new_energy) in pending.items():
+            params.extend((random_id, new_resource, new_energy))
+        insert_sql, insert_cursor = insert_cursor_for(connection, insert_cursors, len(pending))
+
+        delete_cursor.execute(DELETE_BATCH_SQL)
+        insert_cursor.execute(insert_sql, params)
+        update_cursor.execute(UPDATE_BATCH_SQL)
         connection.commit()
-        return True
+        return len(pending)
     except Exception as e:
-        print(f"Error updating row: {e}")
+        if connection is None:
+            # get_conn failed and has already returned the connection to the pool
+            raise
+        if isinstance(e, CONNECTION_ERRORS) and e.errno not in RETRYABLE_ERRNOS:
+            # Connection-level failure: rebuild it and let the caller retry the batch
+            print(f"Connection lost, reconnecting: {e}")
+            reset_conn()
+            raise
         connection.rollback()
-        return False
+        if isinstance(e, mysql.connector.Error) and e.errno in RETRYABLE_ERRNOS:
+            raise
+        print(f"Error updating rows: {e}")
+        return 0
+
+# Function to get the backoff delay after a number of consecutive failures
+def backoff_delay(attempt):
+    # Clamp the exponent so a long outage never overflows the float conversion
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** min(attempt, BACKOFF_MAX_EXPONENT))
 
 # Function to be executed by each thread
 def thread_task(thread_id):
-    connection = pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME,
-        cursorclass=pymysql.cursors.DictCursor
-    )
-
     try:
+        # Latest (resource, energy) per id; repeated ids overwrite each other
+        pending = {}
+        last_flush = time.monotonic()
+        requested_count = 0
         updates_count = 0
+        flush_count = 0
+        attempt = 0
+        failures = 0
         while True:
-            if update_row(connection):
-                updates_count += 1
-                if updates_count % 100 == 0:
-                    print(f"Thread {thread_id}: Updated {updates_count} rows")
-            time.sleep(0.01)  # Small delay to prevent overwhelming the database
+            # While a flush is being retried the batch stays exactly as it was
+            if not attempt:
+                random_id = random.randint(1, MAX_ID)
+                pending[random_id] = (random.randint(100, 10000), random.randint(10, 100))
+                requested_count += 1
+                if len(pending) < FLUSH_ROWS and time.monotonic() - last_flush < FLUSH_INTERVAL:
+                    continue
+
+            try:
+                updated = update_row(pending)
+            except mysql.connector.errors.PoolError:
+                # An exhausted pool is not contention; stop instead of backing off forever
+                raise
+            except mysql.connector.Error:
+                # Contention or a lost connection: keep the batch, back off and retry it;
+                # reset once a batch lands
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            attempt = 0
+            pending.clear()
+            last_flush = time.monotonic()
+            if not updated:
+                # The batch was dropped on a persistent error (e.g. a missing table):
+                # back off as well instead of spinning on it
+                failures += 1
+                time.sleep(backoff_delay(failures))
+                continue
+            failures = 0
+            updates_count += updated
+            flush_count += 1
+            if flush_count % 10 == 0:
+                dedup_ratio = requested_count / updates_count
+                print(f"Thread {thread_id}: Updated {updates_count} rows "
+                      f"for {requested_count} requests (dedup ratio {dedup_ratio:.3f})")
     except Exception as e:
         print(f"An error occurred in thread {thread_id}: {e}")
-    finally:
-        connection.close()
 
 # Main execution
 def main():
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 import argparse
-import concurrent.futures
-import psycopg2
-import psycopg2.pool
+import asyncio
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+import numpy as np
 import random
-import statistics
 import time
 from datetime import datetime
 import logging
@@ -39,137 +40,153 @@ SAMPLE_TIMESTAMPS = [
     1741058782492   # Newer timestamp
 ]
 
+# Queries each connection keeps in flight before waiting for results
+DEFAULT_PIPELINE_DEPTH = 16
+
+# Latest tsver per element; DISTINCT ON walks the (tile, element, tsver DESC)
+# index in order instead of sorting every matching row for a window function.
+# psycopg prepares it server-side on first use (prepare_threshold=0).
+# Only the row count is reported, so count server-side instead of shipping rows.
+BENCH_QUERY = """
+SELECT count(*)
+FROM (
+    SELECT DISTINCT ON (element)
+        element,
+        tsver as max_tsver
+    FROM map
+    WHERE tile = %s AND tsver <= %s
+    ORDER BY element, tsver DESC
+) latest;
+"""
+
 class PostgreSQLBenchmark:
-    def __init__(self, db_config: Dict[str, Any], pool_size: int = 20):
-        """Initialize the benchmark tool with database configuration and connection pool."""
+    def __init__(self, db_config: Dict[str, Any], pool_size: int = 20,
+                 pipeline_depth: int = DEFAULT_PIPELINE_DEPTH):
+        """Initialize the benchmark tool with database configuration."""
         self.db_config = db_config
         self.pool_size = pool_size
+        self.pipeline_depth = pipeline_depth
         self.connection_pool = None
-        self.setup_connection_pool()
         
-    def setup_connection_pool(self):
+    async def setup_connection_pool(self):
         """Create a connection pool for database operations."""
         try:
-            self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=self.pool_size,
-                **self.db_config
+            self.connection_pool = AsyncConnectionPool(
+                make_conninfo(**self.db_config),
+                min_size=1,
+                max_size=self.pool_size,
+                kwargs={'prepare_threshold': 0},
+                open=False
             )
+            await self.connection_pool.open(wait=True)
             logger.info(f"Connection pool created with size {self.pool_size}")
         except Exception as e:
             logger.error(f"Failed to create connection pool: {e}")
             raise
             
-    def close_connection_pool(self):
+    async def close_connection_pool(self):
         """Close all connections in the pool."""
         if self.connection_pool:
-            self.connection_pool.closeall()
+            await self.connection_pool.close()
             logger.info("Connection pool closed")
             
-    def execute_query(self, tile: str, timestamp: int) -> Tuple[float, int]:
-        """Execute the benchmark query and return execution time and row count."""
-        query = """
-        WITH ranked_elements AS (
-            SELECT
-                element,
-                tsver,
-                ROW_NUMBER() OVER (PARTITION BY element ORDER BY tsver DESC) as rn
-            FROM map
-            WHERE tile = %s AND tsver <= %s
-        )
-        SELECT element, tsver as max_tsver
-        FROM ranked_elements
-        WHERE rn = 1;
+    async def execute_pipeline(self, conn: psycopg.AsyncConnection,
+                               pairs: List[Tuple[str, int]]) -> List[Tuple[int, int]]:
+        """Pipeline a window of queries on one connection and return execution time (ns) and row count for each.
+        
+        Results only come back at the pipeline sync, so each query's time runs
+        from its submission until the whole window has been answered.
         """
+        submitted = []
+        async with conn.pipeline() as pipeline:
+            for tile, timestamp in pairs:
+                start_ns = time.perf_counter_ns()
+                cursor = await conn.execute(BENCH_QUERY, (tile, timestamp))
+                submitted.append((start_ns, cursor))
+            await pipeline.sync()
+            done_ns = time.perf_counter_ns()
         
-        conn = None
-        try:
-            start_time = time.time()
-            conn = self.connection_pool.getconn()
-            
-            with conn.cursor() as cursor:
-                cursor.execute(query, (tile, timestamp))
-                results = cursor.fetchall()
-                row_count = len(results)
-                
-            execution_time = time.time() - start_time
-            return execution_time, row_count
-            
-        except Exception as e:
-            logger.error(f"Query execution error: {e}")
-            return None
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
+        results = []
+        for start_ns, cursor in submitted:
+            (row_count,) = await cursor.fetchone()
+            results.append((done_ns - start_ns, row_count))
+        return results
                 
-    def worker_task(self, task_id: int, iterations: int) -> List[Tuple[float, int]]:
+    async def worker_task(self, task_id: int, iterations: int) -> List[Tuple[int, int]]:
         """Worker task that executes multiple queries."""
         results = []
         
-        for i in range(iterations):
-            # Select random tile and timestamp for realistic query variations
-            tile = random.choice(SAMPLE_TILES)
-            timestamp = random.choice(SAMPLE_TIMESTAMPS)
-            
-            result = self.execute_query(tile, timestamp)
-            if result:
-                execution_time, row_count = result
-                logger.debug(f"Task {task_id}, Query {i+1}: {execution_time:.4f}s, {row_count} rows")
-                results.append(result)
+        # Draw random tile/timestamp pairs up front so the loop only runs queries
+        pairs = list(zip(random.choices(SAMPLE_TILES, k=iterations),
+                         random.choices(SAMPLE_TIMESTAMPS, k=iterations)))
+        
+        try:
+            # One connection per worker, with up to pipeline_depth queries in flight
+            async with self.connection_pool.connection() as conn:
+                for start in range(0, len(pairs), self.pipeline_depth):
+                    window = await self.execute_pipeline(conn, pairs[start:start + self.pipeline_depth])
+                    for i, (execution_ns, row_count) in enumerate(window, start + 1):
+                        logger.debug(f"Task {task_id}, Query {i}: {execution_ns / 1e9:.4f}s, {row_count} rows")
+                    results.extend(window)
+        except Exception as e:
+            logger.error(f"Query execution error: {e}")
                 
         return results
                 
-    def run_benchmark(self, concurrency: int, queries_per_thread: int) -> Dict[str, Any]:
+    async def run_benchmark(self, concurrency: int, queries_per_thread: int) -> Dict[str, Any]:
         """Run the benchmark with specified concurrency level."""
         total_queries = concurrency * queries_per_thread
-        logger.info(f"Starting benchmark with {concurrency} threads, {total_queries} total queries")
+        logger.info(f"Starting benchmark with {concurrency} tasks, {total_queries} total queries")
         
-        start_time = time.time()
+        start_time = time.perf_counter()
         results = []
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
-            future_to_task = {
-                executor.submit(self.worker_task, i, queries_per_thread): i 
-                for i in range(concurrency)
-            }
-            
-            for future in concurrent.futures.as_completed(future_to_task):
-                task_id = future_to_task[future]
-                try:
-                    task_results = future.result()
-                    results.extend(task_results)
-                except Exception as e:
-                    logger.error(f"Task {task_id} generated an exception: {e}")
+        # All workers share one event loop, each pipelining on its own pooled connection
+        task_results = await asyncio.gather(
+            *(self.worker_task(i, queries_per_thread) for i in range(concurrency)),
+            return_exceptions=True
+        )
+        
+        for task_id, task_result in enumerate(task_results):
+            if isinstance(task_result, Exception):
+                logger.error(f"Task {task_id} generated an exception: {task_result}")
+            else:
+                results.extend(task_result)
         
-        total_time = time.time() - start_time
+        total_time = time.perf_counter() - start_time
         
         # Calculate statistics
         if not results:
             logger.error("No successful queries to analyze")
             return None
             
-        execution_times = [r[0] for r in results]
+        execution_times_ns = [r[0] for r in results]
         row_counts = [r[1] for r in results]
         
+        # Samples are integer nanoseconds; only the reported figures become seconds.
+        # All reductions run over the same float64 buffer, and p95 only needs one
+        # order statistic: O(n) partition instead of a full sort
+        times = np.asarray(execution_times_ns, dtype=np.float64) / 1e9
+        rows = np.asarray(row_counts, dtype=np.int64)
+        p95_index = int(len(times) * 0.95)
+        
         stats = {
             'concurrency': concurrency,
+            'pipeline_depth': self.pipeline_depth,
             'total_queries': len(results),
             'total_time': total_time,
             'queries_per_second': len(results) / total_time,
-            'min_time': min(execution_times),
-            'max_time': max(execution_times),
-            'avg_time': statistics.mean(execution_times),
-            'median_time': statistics.median(execution_times),
-            'p95_time': sorted(execution_times)[int(len(execution_times) * 0.95)],
-            'total_rows': sum(row_counts),
-            'avg_rows': statistics.mean(row_counts)
+            'min_time': float(times.min()),
+            'max_time': float(times.max()),
+            'avg_time': float(times.mean()),
+            'median_time': float(np.median(times)),
+            'p95_time': float(np.partition(times, p95_index)[p95_index]),
+            # Sample standard deviation, matching statistics.stdev
+            'stddev_time': float(times.std(ddof=1)) if len(times) > 1 else 0,
+            'total_rows': int(rows.sum()),
+            'avg_rows': float(rows.mean())
         }
         
-        try:
-            stats['stddev_time'] = statistics.stdev(execution_times)
-        except statistics.StatisticsError:
-            stats['stddev_time'] = 0
-            
         return stats
 
 def print_benchmark_results(results: Dict[str, Any]):
@@ -181,7 +198,9 @@ def print_benchmark_results(results: Dict[str, Any]):
     print(f"Total execution time:    {results['total_time']:.2f} seconds")
     print(f"Queries per second:      {results['queries_per_second']:.2f}")
     print(f"Average rows returned:   {results['avg_rows']:.2f}")
-    print("\nQuery Execution Time Statistics:")
+    # Pipelined timings run from a query's submission to its window's sync, so they
+    # include time queued behind the rest of the window and are not per-query latency
+    print(f"\nPipelined Query Latency Statistics (submit to window sync, depth {results['pipeline_depth']}):")
     print(f"  Minimum:               {results['min_time']*1000:.2f} ms")
     print(f"  Maximum:               {results['max_time']*1000:.2f} ms")
     print(f"  Average:               {results['avg_time']*1000:.2f} ms")
@@ -190,12 +209,44 @@ def print_benchmark_results(results: Dict[str, Any]):
     print(f"  Standard deviation:    {results['stddev_time']*1000:.2f} ms")
     print("="*60 + "\n")
 
+async def run_benchmarks(db_config: Dict[str, Any], pool_size: int, pipeline_depth: int,
+                         concurrency_levels: List[int], queries_per_thread: int):
+    """Run the benchmark at each concurrency level on a single event loop."""
+    benchmark = PostgreSQLBenchmark(db_config, pool_size, pipeline_depth)
+    await benchmark.setup_connection_pool()
+    
+    all_results = []
+    for concurrency in concurrency_levels:
+        logger.info(f"Running benchmark with concurrency level: {concurrency}")
+        results = await benchmark.run_benchmark(concurrency, queries_per_thread)
+        if results:
+            all_results.append(results)
+            print_benchmark_results(results)
+        
+    # Compare results across different concurrency levels
+    if len(all_results) > 1:
+        print("\nCOMPARISON ACROSS CONCURRENCY LEVELS")
+        print("="*60)
+        print(f"Latencies are pipelined: submit to window sync, depth {all_results[0]['pipeline_depth']}")
+        print(f"{'Concurrency':<12} {'QPS':<10} {'Avg Sync (ms)':<15} {'P95 Sync (ms)':<15}")
+        print("-"*60)
+        
+        for result in all_results:
+            print(f"{result['concurrency']:<12} {result['queries_per_second']:<10.2f} "
+                  f"{result['avg_time']*1000:<15.2f} {result['p95_time']*1000:<15.2f}")
+            
+        print("="*60)
+        
+    await benchmark.close_connection_pool()
+
 def main():
     parser = argparse.ArgumentParser(description='PostgreSQL Query Benchmark Tool')
-    parser.add_argument('--concurrency', type=int, default=[1, 5, 10, 20], nargs='+',
-                        help='Number of concurrent threads (can specify multiple values)')
+    parser.add_argument('--concurrency', type=int, default=[1, 2, 5, 10], nargs='+',
+                        help='Number of concurrent workers (can specify multiple values)')
     parser.add_argument('--queries', type=int, default=100,
-                        help='Number of queries per thread')
+                        help='Number of queries per worker')
+    parser.add_argument('--pipeline-depth', type=int, default=DEFAULT_PIPELINE_DEPTH,
+                        help='Queries kept in flight per connection')
     parser.add_argument('--pool-size', type=int, default=50,
                         help='Maximum size of the connection pool')
     parser.add_argument('--host', type=str, default='localhost',
@@ -224,31 +275,8 @@ def main():
     pool_size = max(args.pool_size, max(args.concurrency))
     
     try:
-        benchmark = PostgreSQLBenchmark(db_config, pool_size)
-        
-        all_results = []
-        for concurrency in args.concurrency:
-            logger.info(f"Running benchmark with concurrency level: {concurrency}")
-            results = benchmark.run_benchmark(concurrency, args.queries)
-            if results:
-                all_results.append(results)
-                print_benchmark_results(results)
-            
-        # Compare results across different concurrency levels
-        if len(all_results) > 1:
-            print("\nCOMPARISON ACROSS CONCURRENCY LEVELS")
-            print("="*60)
-            print(f"{'Concurrency':<12} {'QPS':<10} {'Avg Time (ms)':<15} {'P95 Time (ms)':<15}")
-            print("-"*60)
-            
-            for result in all_results:
-                print(f"{result['concurrency']:<12} {result['queries_per_second']:<10.2f} "
-                      f"{result['avg_time']*1000:<15.2f} {result['p95_time']*1000:<15.2f}")
-                
-            print("="*60)
-            
-        benchmark.close_connection_pool()
-        
+        asyncio.run(run_benchmarks(db_config, pool_size, args.pipeline_depth,
+                                   args.concurrency, args.queries))
     except Exception as e:
         logger.error(f"Benchmark failed: {e}")
         
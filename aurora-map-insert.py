@@ -1,8 +1,14 @@
 import psycopg2
+import numpy as np
 import random
 import time
 import hashlib
 import string
+import io
+import functools
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, cpu_count
 from datetime import datetime, timedelta
 from tqdm import tqdm  # For progress bar
 
@@ -20,18 +26,25 @@ NUM_ROWS = 100000
 BRANCHES = ["north", "south", "east", "west", "central"]
 NUM_TILES_PER_BRANCH = 20
 NUM_ELEMENTS_PER_TILE = 50
+BATCH_SIZE = 1000
+NUM_CONSUMERS = 4  # Parallel COPY connections
+QUEUE_SIZE = 16  # Generated batches waiting for a consumer
+# The table is loaded UNLOGGED, so until it is switched to LOGGED a crash truncates it
+SET_LOGGED_AFTER_LOAD = True  # Set to False to leave the demo table unlogged (crash-unsafe)
 
 # Time range for timestamps (past 30 days)
 END_TIME = int(time.time() * 1000)  # Current time in milliseconds
 START_TIME = END_TIME - (30 * 24 * 60 * 60 * 1000)  # 30 days ago in milliseconds
 
+MAP_COLUMNS = ("branch", "tile", "element", "tsver", "element_value", "element_md5")
+
 def create_table():
     """Create the map table if it doesn't exist"""
     conn = psycopg2.connect(**DB_PARAMS)
     cursor = conn.cursor()
     
     cursor.execute("""
-    CREATE TABLE IF NOT EXISTS map (
+    CREATE UNLOGGED TABLE IF NOT EXISTS map (
         branch VARCHAR(10) NOT NULL,
         tile VARCHAR(10) NOT NULL,
         element VARCHAR(10) NOT NULL,
@@ -42,36 +55,68 @@ def create_table():
     );
     """)
     
-    # Create index for our specific query pattern
+    # IF NOT EXISTS keeps a map table from an earlier run, which may be logged
+    cursor.execute("ALTER TABLE map SET UNLOGGED;")
+    
+    # Secondary index is built after the load (see finish_load)
     cursor.execute("DROP INDEX IF EXISTS idx_map_tile_tsver;")
-    cursor.execute("CREATE INDEX idx_map_tile_tsver ON map (tile, tsver DESC);")
+    cursor.execute("DROP INDEX IF EXISTS idx_map_tile_element_tsver;")
+    
+    conn.commit()
+    cursor.close()
+    conn.close()
+    
+    print("Table created successfully")
+
+def finish_load():
+    """Make the table durable, then build the query index in one pass"""
+    conn = psycopg2.connect(**DB_PARAMS)
+    cursor = conn.cursor()
+    
+    # SET LOGGED rewrites the heap and every index, so it runs before the index exists
+    if SET_LOGGED_AFTER_LOAD:
+        cursor.execute("ALTER TABLE map SET LOGGED;")
+    
+    # Create index for our specific query pattern (latest tsver per element of a tile)
+    cursor.execute("CREATE INDEX idx_map_tile_element_tsver ON map (tile, element, tsver DESC);")
     
     conn.commit()
     cursor.close()
     conn.close()
     
-    print("Table and index created successfully")
+    print("Index created successfully")
 
+@functools.lru_cache(maxsize=4096)
 def generate_md5(text):
     """Generate MD5 hash for a given text"""
     return hashlib.md5(text.encode()).hexdigest()[:16]
 
+def make_name():
+    """Generate a random capitalized name"""
+    return f"{''.join(random.choices(string.ascii_uppercase, k=1))}{''.join(random.choices(string.ascii_lowercase, k=random.randint(4, 8)))}"
+
+# Precomputed value pools; names are drawn once instead of synthesized per row
+STATUSES = ["active", "inactive", "pending", "damaged", "new"]
+CATEGORIES = ["residential", "commercial", "industrial", "public", "private"]
+NAME_POOL = [make_name() for _ in range(2048)]
+VALUE_POOLS = (NAME_POOL, STATUSES, CATEGORIES)
+
 def generate_element_value():
     """Generate a random element value"""
-    value_type = random.choice(["name", "status", "category"])
-    if value_type == "name":
-        return f"{''.join(random.choices(string.ascii_uppercase, k=1))}{''.join(random.choices(string.ascii_lowercase, k=random.randint(4, 8)))}"
-    elif value_type == "status":
-        return random.choice(["active", "inactive", "pending", "damaged", "new"])
-    else:  # category
-        return random.choice(["residential", "commercial", "industrial", "public", "private"])
+    # Pick the value type first to keep the name/status/category split even
+    return random.choice(random.choice(VALUE_POOLS))
 
-def insert_data():
-    """Generate and insert 100,000 rows of data"""
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-    
-    # Prepare data structures to ensure we have unique combinations
+def copy_rows(cursor, rows):
+    """Stream a batch of rows into the map table with a single COPY"""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(map(str, row)))
+        buf.write("\n")
+    buf.seek(0)
+    cursor.copy_from(buf, "map", columns=MAP_COLUMNS)
+
+def build_layout():
+    """Build the tile and element identifiers for every branch"""
     # FIXED: Ensure all identifiers are <= 10 characters
     all_tiles = {}
     for branch in BRANCHES:
@@ -87,50 +132,97 @@ def insert_data():
                                          for prefix in element_prefixes 
                                          for i in range(1, 11)]  # 10 elements per prefix
     
-    # Generate and insert data in batches
-    batch_size = 1000
-    data_to_insert = []
+    return all_tiles, all_elements
+
+ALL_TILES, ALL_ELEMENTS = build_layout()
+
+# Every (branch, tile, element) combination, so one index draw picks all three
+LAYOUT_KEYS = [(branch, tile, element)
+               for branch in BRANCHES
+               for tile in ALL_TILES[branch]
+               for element in ALL_ELEMENTS[branch][tile]]
+
+def gen_batch(n):
+    """Generate a batch of n rows (runs in a worker process)"""
+    # Fresh OS-seeded generator so forked workers don't share a random stream
+    rng = np.random.default_rng()
+    key_indexes = rng.integers(0, len(LAYOUT_KEYS), size=n).tolist()
+    tsvers = rng.integers(START_TIME, END_TIME, size=n, dtype=np.int64, endpoint=True).tolist()
     
-    with tqdm(total=NUM_ROWS) as pbar:
-        for i in range(NUM_ROWS):
-            # Select random branch, tile, and element
-            branch = random.choice(BRANCHES)
-            tile = random.choice(all_tiles[branch])
-            element = random.choice(all_elements[branch][tile])
-            
-            # Generate random timestamp within our range
-            tsver = random.randint(START_TIME, END_TIME)
-            
-            # Generate element value and its MD5
-            element_value = generate_element_value()
-            element_md5 = generate_md5(element_value)
-            
-            # Add to batch
-            data_to_insert.append((branch, tile, element, tsver, element_value, element_md5))
-            
-            # Insert batch if we've reached batch size
-            if len(data_to_insert) >= batch_size:
-                cursor.executemany(
-                    "INSERT INTO map (branch, tile, element, tsver, element_value, element_md5) VALUES (%s, %s, %s, %s, %s, %s)",
-                    data_to_insert
-                )
-                conn.commit()
-                data_to_insert = []
-                pbar.update(batch_size)
+    rows = []
+    for key_index, tsver in zip(key_indexes, tsvers):
+        branch, tile, element = LAYOUT_KEYS[key_index]
+        
+        # Generate element value and its MD5
+        element_value = generate_element_value()
+        element_md5 = generate_md5(element_value)
         
-        # Insert any remaining records
-        if data_to_insert:
-            cursor.executemany(
-                "INSERT INTO map (branch, tile, element, tsver, element_value, element_md5) VALUES (%s, %s, %s, %s, %s, %s)",
-                data_to_insert
-            )
+        rows.append((branch, tile, element, tsver, element_value, element_md5))
+    
+    # Primary key order, so COPY touches B-tree leaf pages sequentially
+    rows.sort(key=lambda r: (r[0], r[1], r[2], r[3]))
+    
+    return rows
+
+def consume_batches(q, consumer_id, pbar):
+    """COPY batches from the queue over a dedicated connection"""
+    conn = psycopg2.connect(**DB_PARAMS)
+    cursor = conn.cursor()
+    rows_inserted = 0
+    
+    try:
+        while True:
+            rows = q.get()
+            if rows is None:  # Poison pill - exit signal
+                break
+            # Commit each batch so an error only loses the batch in flight
+            copy_rows(cursor, rows)
             conn.commit()
-            pbar.update(len(data_to_insert))
+            rows_inserted += len(rows)
+            pbar.update(len(rows))
+    except Exception as e:
+        # Leave the remaining batches to the other consumers
+        print(f"Consumer {consumer_id} error: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+        conn.close()
     
-    cursor.close()
-    conn.close()
+    return rows_inserted
+
+def put_batch(q, item, futures):
+    """Queue an item for the consumers, failing if none of them is left to take it"""
+    while True:
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            if all(future.done() for future in futures):
+                raise RuntimeError("All COPY consumers have stopped")
+
+def insert_data():
+    """Generate and insert 100,000 rows of data"""
+    batch_sizes = [min(BATCH_SIZE, NUM_ROWS - start) for start in range(0, NUM_ROWS, BATCH_SIZE)]
+    
+    # Bounded queue gives backpressure between generators and COPY consumers
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    
+    # Generator processes are forked before any consumer or tqdm thread exists,
+    # since forking a multi-threaded process can deadlock in the child
+    with Pool(cpu_count()) as pool, tqdm(total=NUM_ROWS) as pbar:
+        with ThreadPoolExecutor(max_workers=NUM_CONSUMERS) as executor:
+            futures = [executor.submit(consume_batches, q, i, pbar) for i in range(NUM_CONSUMERS)]
+            
+            # Generate batches on all cores while the consumers write
+            for rows in pool.imap_unordered(gen_batch, batch_sizes):
+                put_batch(q, rows, futures)
+            
+            for _ in range(NUM_CONSUMERS):
+                put_batch(q, None, futures)
+            
+            total_inserted = sum(future.result() for future in futures)
     
-    print(f"Successfully inserted {NUM_ROWS} rows of data")
+    print(f"Successfully inserted {total_inserted} rows of data")
 
 def test_query():
     """Test our target query on a random tile"""
@@ -195,6 +287,7 @@ def main():
     print("Starting map data generation process...")
     create_table()
     insert_data()
+    finish_load()
     test_query()
     print("Process completed successfully!")
 
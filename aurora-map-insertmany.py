@@ -1,5 +1,5 @@
-import psycopg2
-from psycopg2.extras import execute_values
+import psycopg
+import numpy as np
 import random
 import time
 import hashlib
@@ -9,6 +9,8 @@ from datetime import datetime
 from tqdm import tqdm
 import os
 import queue
+from collections import deque
+from dataclasses import dataclass
 
 # Database connection parameters - replace with your actual values
 DB_PARAMS = {
@@ -26,97 +28,187 @@ NUM_TILES_PER_BRANCH = 20
 NUM_WORKERS = min(32, os.cpu_count() * 2)  # Use 2x CPU cores, max 32
 BATCH_SIZE = 10000  # Increased batch size for better performance
 QUEUE_SIZE = NUM_WORKERS * 3  # Keep a few batches ready per worker
+COMMIT_THRESHOLD = 200_000  # Rows per transaction in each worker
+NUM_GENERATORS = os.cpu_count()  # Processes generating batches
+GENERATOR_BACKLOG = NUM_GENERATORS * 2  # Batches generating ahead of the queue
+MAINTENANCE_WORK_MEM = "4GB"  # Sort memory for the post-load index build
+MAINTENANCE_WORKERS = 8  # Parallel workers for the post-load index build
+# The table is loaded UNLOGGED, so until it is switched to LOGGED a crash truncates it
+SET_LOGGED_AFTER_LOAD = True  # Set to False to leave the benchmark table unlogged (crash-unsafe)
+TILE_KEY_SHIFT = 42  # Bits of tsver below the tile hash in tile_key
 
 # Time range for timestamps (past 30 days)
 END_TIME = int(time.time() * 1000)  # Current time in milliseconds
 START_TIME = END_TIME - (30 * 24 * 60 * 60 * 1000)  # 30 days ago in milliseconds
 
+# Every row gets its own tsver slot so generated keys never collide on the primary key.
+# Row numbers are scattered over the slots by multiplying with a constant coprime to
+# NUM_ROWS, so each batch still spans the whole time range. Slot starts are spread over
+# the full span, so they are at least TSVER_STRIDE apart and jitter below that stays unique
+TSVER_STRIDE = (END_TIME - START_TIME) // NUM_ROWS  # Minimum milliseconds between slot starts
+TSVER_SCATTER = 2_654_435_761  # Prime, so coprime to NUM_ROWS
+
 # Pre-generate some values to avoid repeated random generation
 ELEMENT_VALUES = [
     "active", "inactive", "pending", "damaged", "new",
     "residential", "commercial", "industrial", "public", "private"
 ] + [f"{''.join(random.choices(string.ascii_uppercase, k=1))}{''.join(random.choices(string.ascii_lowercase, k=5))}" for _ in range(40)]
 
+# Pre-generate all tiles and elements
+ALL_TILES = [f"t{i:03d}" for i in range(1, NUM_TILES_PER_BRANCH + 1)]
+
+ELEMENT_PREFIXES = ["rd", "bld", "poi", "trf", "ter"]
+ALL_ELEMENTS = [f"{prefix}{i:03d}" for prefix in ELEMENT_PREFIXES for i in range(1, 11)]
+
+# Binary COPY needs the exact server type of every column
+COPY_SQL = "COPY map (branch, tile, element, tsver, element_value, element_md5) FROM STDIN (FORMAT BINARY)"
+COPY_TYPES = ["varchar", "varchar", "varchar", "int8", "varchar", "bytea"]
+
 def create_table():
     """Create the map table if it doesn't exist"""
-    conn = psycopg2.connect(**DB_PARAMS)
+    conn = psycopg.connect(**DB_PARAMS)
     cursor = conn.cursor()
     
     # Drop existing table for clean start (comment out if you want to keep existing data)
     cursor.execute("DROP TABLE IF EXISTS map;")
     
     cursor.execute("""
-    CREATE TABLE IF NOT EXISTS map (
+    CREATE UNLOGGED TABLE IF NOT EXISTS map (
         branch VARCHAR(10) NOT NULL,
         tile VARCHAR(10) NOT NULL,
         element VARCHAR(10) NOT NULL,
         tsver BIGINT NOT NULL,
         element_value VARCHAR(20),
-        element_md5 CHAR(16),
+        element_md5 BYTEA,
+        -- 20-bit hash of tile above a 42-bit tsver (millisecond epochs fit in 41 bits)
+        tile_key BIGINT GENERATED ALWAYS AS (
+            (('x' || substr(md5(tile), 1, 5))::bit(20)::bigint << 42) | tsver
+        ) STORED,
         PRIMARY KEY (branch, tile, element, tsver)
     );
     """)
     
-    # Create index for our specific query pattern
+    conn.commit()
+    cursor.close()
+    conn.close()
+    
+    print("Table created successfully")
+
+def build_indexes():
+    """Make the table durable, then build the query indexes in sorted passes"""
+    conn = psycopg.connect(**DB_PARAMS)
+    cursor = conn.cursor()
+    
+    # More sort memory and parallel workers for every index build on this session only,
+    # including the primary key rebuild done by SET LOGGED
+    cursor.execute(f"SET maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'")
+    cursor.execute(f"SET max_parallel_maintenance_workers = {MAINTENANCE_WORKERS}")
+    
+    # The load skipped WAL; write the table out once now if it should survive a crash.
+    # SET LOGGED rewrites the heap and every index, so it runs before the index exists
+    if SET_LOGGED_AFTER_LOAD:
+        cursor.execute("ALTER TABLE map SET LOGGED;")
+    
+    # Create index for our specific query pattern: one tile's tsver range is one tile_key range.
+    # btree rather than BRIN, since rows are not loaded in tile_key order
+    cursor.execute("DROP INDEX IF EXISTS idx_map_tile_key;")
+    cursor.execute("CREATE INDEX idx_map_tile_key ON map (tile_key);")
+    
+    # Readers still filtering on tile = %s AND tsver <= %s (aurora-map-bench.py, and
+    # query-bench2 against tables without tile_key) need the original index too
     cursor.execute("DROP INDEX IF EXISTS idx_map_tile_tsver;")
     cursor.execute("CREATE INDEX idx_map_tile_tsver ON map (tile, tsver DESC);")
+    cursor.execute("ANALYZE map;")
     
     conn.commit()
     cursor.close()
     conn.close()
     
-    print("Table and index created successfully")
+    print("Indexes created successfully")
+
+def tile_key(tile, tsver):
+    """Compute the tile_key generated column for a tile and tsver"""
+    return (int(hashlib.md5(tile.encode()).hexdigest()[:5], 16) << TILE_KEY_SHIFT) | tsver
 
 def generate_md5(text):
-    """Generate MD5 hash for a given text"""
-    return hashlib.md5(text.encode()).hexdigest()[:16]
+    """Generate the first 8 raw bytes of the MD5 hash for a given text"""
+    return hashlib.md5(text.encode()).digest()[:8]
+
+# element_value only ever comes from ELEMENT_VALUES, so hash each one once
+# (same positions as ELEMENT_VALUES, so one value index selects both columns)
+ELEMENT_MD5 = {value: generate_md5(value) for value in ELEMENT_VALUES}
+ELEMENT_MD5S = [ELEMENT_MD5[value] for value in ELEMENT_VALUES]
 
-def generate_batch(batch_id, batch_size, all_tiles, all_elements):
+@dataclass
+class BatchSoA:
+    """A batch of rows as one index/value array per column"""
+    branch_idx: np.ndarray
+    tile_idx: np.ndarray
+    element_idx: np.ndarray
+    tsver: np.ndarray
+    value_idx: np.ndarray
+    
+    def __len__(self):
+        return len(self.tsver)
+    
+    def rows(self):
+        """Decode the arrays back into COPY rows one at a time"""
+        for b, t, e, ts, v in zip(self.branch_idx.tolist(), self.tile_idx.tolist(),
+                                  self.element_idx.tolist(), self.tsver.tolist(),
+                                  self.value_idx.tolist()):
+            yield BRANCHES[b], ALL_TILES[t], ALL_ELEMENTS[e], ts, ELEMENT_VALUES[v], ELEMENT_MD5S[v]
+
+def generate_batch(batch_id, batch_size):
     """Generate a batch of data rows"""
-    batch_data = []
+    rng = np.random.default_rng()
     
-    for _ in range(batch_size):
-        # Select random branch, tile, and element
-        branch = random.choice(BRANCHES)
-        tile = random.choice(all_tiles)
-        element = random.choice(all_elements)
-        
-        # Generate random timestamp within our range
-        tsver = random.randint(START_TIME, END_TIME)
-        
-        # Get pre-generated element value and calculate its MD5
-        element_value = random.choice(ELEMENT_VALUES)
-        element_md5 = generate_md5(element_value)
-        
-        # Add to batch
-        batch_data.append((branch, tile, element, tsver, element_value, element_md5))
+    # This batch's rows map to distinct tsver slots (see TSVER_SCATTER)
+    row_numbers = np.arange(batch_id * BATCH_SIZE, batch_id * BATCH_SIZE + batch_size, dtype=np.int64)
+    slots = (row_numbers * TSVER_SCATTER) % NUM_ROWS
     
-    return batch_data
+    # Draw every column for the whole batch at once, shipped as compact arrays
+    return BatchSoA(
+        branch_idx=rng.integers(0, len(BRANCHES), batch_size, dtype=np.int32),
+        tile_idx=rng.integers(0, len(ALL_TILES), batch_size, dtype=np.int32),
+        element_idx=rng.integers(0, len(ALL_ELEMENTS), batch_size, dtype=np.int32),
+        tsver=START_TIME + slots * (END_TIME - START_TIME) // NUM_ROWS + rng.integers(0, TSVER_STRIDE, batch_size, dtype=np.int64),
+        value_idx=rng.integers(0, len(ELEMENT_VALUES), batch_size, dtype=np.int32),
+    )
 
 def worker_insert(q, worker_id, total_progress):
     """Worker function to insert data batches from the queue"""
-    conn = psycopg2.connect(**DB_PARAMS)
+    conn = psycopg.connect(**DB_PARAMS)
+    conn.autocommit = False
     cursor = conn.cursor()
     
+    # Bulk load of synthetic data: a crash just means re-running the script
+    cursor.execute("SET synchronous_commit = off")
+    conn.commit()
+    
     rows_inserted = 0
+    uncommitted_rows = 0
     
     while True:
         try:
             batch_data = q.get(timeout=5)  # Wait up to 5 seconds for new data
             if batch_data is None:  # Poison pill - exit signal
+                q.task_done()
                 break
                 
-            # Use execute_values for much faster batch inserts
-            execute_values(
-                cursor,
-                "INSERT INTO map (branch, tile, element, tsver, element_value, element_md5) VALUES %s",
-                batch_data,
-                template="(%s, %s, %s, %s, %s, %s)"
-            )
-            conn.commit()
+            # Stream the batch with binary COPY, bypassing INSERT parsing entirely
+            with cursor.copy(COPY_SQL) as copy:
+                copy.set_types(COPY_TYPES)
+                for row in batch_data.rows():
+                    copy.write_row(row)
             
-            rows_inserted += len(batch_data)
-            total_progress.update(len(batch_data))
+            # Group several batches per transaction to amortize the commit; progress
+            # only counts committed rows, which also keeps tqdm lock traffic coarse
+            uncommitted_rows += len(batch_data)
+            if uncommitted_rows >= COMMIT_THRESHOLD:
+                conn.commit()
+                rows_inserted += uncommitted_rows
+                total_progress.update(uncommitted_rows)
+                uncommitted_rows = 0
             q.task_done()
             
         except queue.Empty:
@@ -125,63 +217,75 @@ def worker_insert(q, worker_id, total_progress):
                 break
         except Exception as e:
             print(f"Worker {worker_id} error: {e}")
-            conn.rollback()  # Rollback on error
+            conn.rollback()  # Rollback on error, dropping every uncommitted batch
+            uncommitted_rows = 0
             q.task_done()
     
+    # Commit whatever is left at shutdown
+    conn.commit()
+    rows_inserted += uncommitted_rows
+    total_progress.update(uncommitted_rows)
+    
     cursor.close()
     conn.close()
     return rows_inserted
 
 def insert_data_parallel():
-    """Generate and insert data using multiple worker threads"""
-    # Pre-generate all tiles and elements
-    all_tiles = [f"t{i:03d}" for i in range(1, NUM_TILES_PER_BRANCH + 1)]
-    
-    element_prefixes = ["rd", "bld", "poi", "trf", "ter"]
-    all_elements = [f"{prefix}{i:03d}" for prefix in element_prefixes for i in range(1, 11)]
-    
+    """Generate batches in worker processes and insert them using multiple worker threads"""
     # Create a queue for batches
     q = queue.Queue(maxsize=QUEUE_SIZE)
     
-    # Create a shared progress bar
-    total_progress = tqdm(total=NUM_ROWS, desc="Inserting rows")
-    
-    # Start worker threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        # Submit worker tasks
-        futures = [executor.submit(worker_insert, q, i, total_progress) for i in range(NUM_WORKERS)]
+    # Start processes for GIL-bound batch generation before any thread exists: forking a
+    # multi-threaded process (DB worker threads, tqdm's monitor) can deadlock in the child.
+    # With the fork start method the first submit forks every generator at once
+    with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_GENERATORS) as generators:
+        generators.submit(int).result()
+        
+        # Create a shared progress bar
+        total_progress = tqdm(total=NUM_ROWS, desc="Committed rows")
         
-        # Generate and queue batches
-        batches_needed = NUM_ROWS // BATCH_SIZE
-        if NUM_ROWS % BATCH_SIZE > 0:
-            batches_needed += 1
+        # Start worker threads for DB I/O
+        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+            # Submit worker tasks
+            futures = [executor.submit(worker_insert, q, i, total_progress) for i in range(NUM_WORKERS)]
+        
+            # Generate and queue batches
+            batches_needed = NUM_ROWS // BATCH_SIZE
+            if NUM_ROWS % BATCH_SIZE > 0:
+                batches_needed += 1
             
-        for batch_id in range(batches_needed):
-            # For the last batch, adjust size if needed
-            current_batch_size = min(BATCH_SIZE, NUM_ROWS - (batch_id * BATCH_SIZE))
+            # Keep a bounded number of batches generating so results don't pile up in memory
+            pending = deque()
+            for batch_id in range(batches_needed):
+                # For the last batch, adjust size if needed
+                current_batch_size = min(BATCH_SIZE, NUM_ROWS - (batch_id * BATCH_SIZE))
             
-            # Generate the batch
-            batch_data = generate_batch(batch_id, current_batch_size, all_tiles, all_elements)
+                # Generate the batch
+                pending.append(generators.submit(generate_batch, batch_id, current_batch_size))
             
-            # Put in queue (will block if queue is full, providing backpressure)
-            q.put(batch_data)
+                # Put in queue (will block if queue is full, providing backpressure)
+                if len(pending) >= GENERATOR_BACKLOG:
+                    q.put(pending.popleft().result())
+        
+            while pending:
+                q.put(pending.popleft().result())
         
-        # Send termination signal to workers
-        for _ in range(NUM_WORKERS):
-            q.put(None)
+            # Send termination signal to workers
+            for _ in range(NUM_WORKERS):
+                q.put(None)
             
-        # Wait for all tasks to complete
-        q.join()
+            # Wait for all tasks to complete
+            q.join()
         
-        # Get results from workers
-        total_inserted = sum(future.result() for future in futures)
+            # Get results from workers
+            total_inserted = sum(future.result() for future in futures)
     
     total_progress.close()
     print(f"Successfully inserted {total_inserted:,} rows of data")
 
 def test_query():
     """Test our target query on a random tile"""
-    conn = psycopg2.connect(**DB_PARAMS)
+    conn = psycopg.connect(**DB_PARAMS)
     cursor = conn.cursor()
     
     # Select a random tile
@@ -199,9 +303,9 @@ def test_query():
     cursor.execute("""
     SELECT element, MAX(tsver) as max_tsver
     FROM map
-    WHERE tile = %s AND tsver <= %s
+    WHERE tile = %s AND tile_key BETWEEN %s AND %s
     GROUP BY element
-    """, (test_tile, query_time))
+    """, (test_tile, tile_key(test_tile, 0), tile_key(test_tile, query_time)))
     
     results = cursor.fetchall()
     query_time_ms = (time.time() - start_time) * 1000
@@ -224,9 +328,9 @@ def test_query():
     cursor.execute("""
     SELECT element, MAX(tsver)
     FROM map
-    WHERE tile = %s AND tsver <= %s
+    WHERE tile = %s AND tile_key BETWEEN %s AND %s
     GROUP BY element
-    """, (specific_tile, specific_time))
+    """, (specific_tile, tile_key(specific_tile, 0), tile_key(specific_tile, specific_time)))
     
     specific_results = cursor.fetchall()
     specific_query_time_ms = (time.time() - start_time) * 1000
@@ -242,6 +346,7 @@ def main():
     print(f"Using {NUM_WORKERS} worker threads for parallel insertion")
     create_table()
     insert_data_parallel()  # Using the parallel version instead of the original
+    build_indexes()
     test_query()
     print("Process completed successfully!")
 
@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
-import psycopg2
+import asyncio
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
 import time
 import random
-import threading
+import hashlib
 import argparse
-import statistics
-import concurrent.futures
-from queue import Queue
+import numpy as np
 from datetime import datetime
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Configuration
 DEFAULT_CONFIG = {
     "host": "localhost",
@@ -27,138 +32,170 @@ SAMPLE_TILES = ['t001', 't002', 't003', 't004', 't005', 't006', 't007', 't008',
 current_time_ms = int(time.time() * 1000)
 SAMPLE_TIMESTAMPS = [current_time_ms - random.randint(0, 30*24*60*60*1000) for _ in range(20)]
 
+# tile_key packs a 20-bit hash of tile above a 42-bit tsver (see aurora-map-insertmany.py)
+TILE_KEY_SHIFT = 42
+
+def tile_key(tile, tsver):
+    """Compute the tile_key generated column for a tile and tsver"""
+    return (int(hashlib.md5(tile.encode()).hexdigest()[:5], 16) << TILE_KEY_SHIFT) | tsver
+
+# Every (tile, timestamp) combination as ready-made query parameters, so one random
+# index picks them all
+QUERY_PARAMS = tuple((tile, ts) for tile in SAMPLE_TILES for ts in SAMPLE_TIMESTAMPS)
+NUM_QUERY_PARAMS = len(QUERY_PARAMS)
+
+# Same combinations for tables with tile_key: tsver <= ts becomes the tile_key range
+# [tile_key(tile, 0), tile_key(tile, ts)]
+TILE_KEY_QUERY_PARAMS = tuple((tile, tile_key(tile, 0), tile_key(tile, ts)) for tile, ts in QUERY_PARAMS)
+
+# Executed with prepare=True so each connection parses and plans it only once
+QUERY = """
+SELECT element, MAX(tsver) as max_tsver
+FROM map
+WHERE tile = %s AND tsver <= %s
+GROUP BY element
+"""
+
+# Used instead when the map table has the tile_key column (aurora-map-insertmany.py schema)
+TILE_KEY_QUERY = """
+SELECT element, MAX(tsver) as max_tsver
+FROM map
+WHERE tile = %s AND tile_key BETWEEN %s AND %s
+GROUP BY element
+"""
+
+TILE_KEY_COLUMN_SQL = """
+SELECT 1 FROM information_schema.columns
+WHERE table_schema = current_schema() AND table_name = 'map' AND column_name = 'tile_key'
+"""
+
+# Queries each connection keeps in flight before waiting for results
+PIPELINE_DEPTH = 16
+
 class PostgreSQLBenchmark:
-    def __init__(self, db_config):
+    def __init__(self, db_config, max_concurrency):
         self.db_config = db_config
-        self.results_queue = Queue()
-        self.stop_event = threading.Event()
-
-    def create_connection(self):
-        """Create and return a database connection"""
-        return psycopg2.connect(
-            host=self.db_config['host'],
-            port=self.db_config['port'],
-            database=self.db_config['database'],
-            user=self.db_config['user'],
-            password=self.db_config['password']
+        self.stop_event = asyncio.Event()
+        
+        # One connection per worker at the highest step, reused by every step;
+        # opened on the event loop in run()
+        self.pool = AsyncConnectionPool(
+            make_conninfo(
+                host=self.db_config['host'],
+                port=self.db_config['port'],
+                dbname=self.db_config['database'],
+                user=self.db_config['user'],
+                password=self.db_config['password']
+            ),
+            min_size=max_concurrency,
+            max_size=max_concurrency,
+            open=False
         )
+        
+        # Plain tsver predicate until choose_query() finds a tile_key column
+        self.query = QUERY
+        self.query_params = QUERY_PARAMS
+    
+    async def choose_query(self):
+        """Use the tile_key form of the query if the map table has that column"""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(TILE_KEY_COLUMN_SQL)
+            if await cursor.fetchone():
+                self.query = TILE_KEY_QUERY
+                self.query_params = TILE_KEY_QUERY_PARAMS
     
-    def get_random_query_params(self):
+    def get_random_query_params(self, _random=random.random):
         """Generate random but realistic query parameters"""
-        tile = random.choice(SAMPLE_TILES)
-        max_tsver = random.choice(SAMPLE_TIMESTAMPS)
-        return tile, max_tsver
+        return self.query_params[int(_random() * NUM_QUERY_PARAMS)]
     
-    def execute_query(self, thread_id):
+    async def execute_query(self, thread_id):
         """Execute query with random parameters and measure performance"""
-        conn = self.create_connection()
-        cursor = conn.cursor()
-        
-        query_count = 0
-        start_time = time.time()
+        query_times = []
+        result_counts = []
+        start_time = time.perf_counter()
         
         try:
-            while not self.stop_event.is_set():
-                tile, max_tsver = self.get_random_query_params()
+            async with self.pool.connection() as conn:
+                while not self.stop_event.is_set():
+                    # Submit a window of queries back to back, then collect all results
+                    # at one sync; each query's time runs from its submit to that sync
+                    submitted = []
+                    async with conn.pipeline() as pipeline:
+                        for _ in range(PIPELINE_DEPTH):
+                            params = self.get_random_query_params()
+                            query_start = time.perf_counter()
+                            cursor = await conn.execute(self.query, params, prepare=True)
+                            submitted.append((query_start, cursor))
+                        await pipeline.sync()
+                        query_end = time.perf_counter()
                 
-                query = """
-                SELECT element, MAX(tsver) as max_tsver
-                FROM map
-                WHERE tile = %s AND tsver <= %s
-                GROUP BY element
-                """
-                
-                query_start = time.time()
-                cursor.execute(query, (tile, max_tsver))
-                results = cursor.fetchall()
-                query_end = time.time()
-                
-                query_time = query_end - query_start
-                result_count = len(results)
-                
-                self.results_queue.put({
-                    'thread_id': thread_id,
-                    'query_time': query_time,
-                    'result_count': result_count,
-                    'tile': tile,
-                    'max_tsver': max_tsver
-                })
-                
-                query_count += 1
+                    # Keep results local to the worker; they are merged once at the end
+                    for query_start, cursor in submitted:
+                        query_times.append(query_end - query_start)
+                        result_counts.append(len(await cursor.fetchall()))
         
         except Exception as e:
             print(f"Thread {thread_id} error: {e}")
-        finally:
-            cursor.close()
-            conn.close()
             
-        return query_count, time.time() - start_time
+        return query_times, result_counts, time.perf_counter() - start_time
     
-    def run_benchmark(self, concurrency, duration):
+    async def run_benchmark(self, concurrency, duration):
         """Run benchmark with specified concurrency for a given duration"""
-        print(f"\nStarting benchmark with {concurrency} concurrent threads for {duration} seconds...")
+        print(f"\nStarting benchmark with {concurrency} concurrent workers for {duration} seconds...")
         
-        # Reset results queue and stop event
-        self.results_queue = Queue()
+        # Reset stop event
         self.stop_event.clear()
         
-        # Start worker threads
-        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
-            futures = [executor.submit(self.execute_query, i) for i in range(concurrency)]
-            
-            # Run for specified duration
-            time.sleep(duration)
-            self.stop_event.set()
-            
-            # Wait for all threads to complete
-            concurrent.futures.wait(futures)
-            
-            # Collect results
-            thread_results = [future.result() for future in futures]
-            total_queries = sum(result[0] for result in thread_results)
+        # Start worker tasks on the event loop
+        tasks = [asyncio.create_task(self.execute_query(i)) for i in range(concurrency)]
         
-        # Process results
-        query_times = []
-        result_counts = []
+        # Run for specified duration
+        await asyncio.sleep(duration)
+        self.stop_event.set()
+        
+        # Wait for all workers to complete and collect results
+        thread_results = await asyncio.gather(*tasks)
         
-        while not self.results_queue.empty():
-            result = self.results_queue.get()
-            query_times.append(result['query_time'])
-            result_counts.append(result['result_count'])
+        # Merge the per-worker results
+        query_times = np.array([t for times, _, _ in thread_results for t in times], dtype=np.float64)
+        result_counts = np.array([c for _, counts, _ in thread_results for c in counts], dtype=np.int64)
+        total_queries = len(query_times)
         
-        # Calculate statistics
+        # Calculate statistics (percentile selects rather than sorting every sample)
         stats = {
             'concurrency': concurrency,
             'total_queries': total_queries,
             'queries_per_second': total_queries / duration,
-            'avg_query_time': statistics.mean(query_times) if query_times else 0,
-            'min_query_time': min(query_times) if query_times else 0,
-            'max_query_time': max(query_times) if query_times else 0,
-            'p95_query_time': sorted(query_times)[int(len(query_times) * 0.95)] if len(query_times) >= 20 else 0,
-            'avg_result_count': statistics.mean(result_counts) if result_counts else 0
+            'avg_query_time': float(query_times.mean()) if total_queries else 0,
+            'min_query_time': float(query_times.min()) if total_queries else 0,
+            'max_query_time': float(query_times.max()) if total_queries else 0,
+            'p95_query_time': float(np.percentile(query_times, 95)) if total_queries >= 20 else 0,
+            'avg_result_count': float(result_counts.mean()) if total_queries else 0
         }
         
         return stats
     
-    def run_escalating_benchmark(self, max_concurrency, step_size, duration_per_step):
+    async def run_escalating_benchmark(self, max_concurrency, step_size, duration_per_step):
         """Run benchmarks with increasing concurrency"""
         results = []
         
-        print(f"Starting escalating benchmark up to {max_concurrency} concurrent threads")
+        print(f"Starting escalating benchmark up to {max_concurrency} concurrent workers")
         print(f"Step size: {step_size}, Duration per step: {duration_per_step} seconds")
+        # Queries are pipelined, so each time runs from submission to its window's sync
+        print(f"Query times are pipelined latencies: submit to window sync, depth {PIPELINE_DEPTH}")
         print("-" * 80)
         
         for concurrency in range(step_size, max_concurrency + 1, step_size):
-            stats = self.run_benchmark(concurrency, duration_per_step)
+            stats = await self.run_benchmark(concurrency, duration_per_step)
             results.append(stats)
             
-            print(f"\nResults for {concurrency} concurrent threads:")
+            print(f"\nResults for {concurrency} concurrent workers:")
             print(f"  Queries executed: {stats['total_queries']}")
             print(f"  Queries per second: {stats['queries_per_second']:.2f}")
-            print(f"  Avg query time: {stats['avg_query_time']*1000:.2f} ms")
-            print(f"  Min query time: {stats['min_query_time']*1000:.2f} ms")
-            print(f"  Max query time: {stats['max_query_time']*1000:.2f} ms")
-            print(f"  P95 query time: {stats['p95_query_time']*1000:.2f} ms")
+            print(f"  Avg pipelined latency: {stats['avg_query_time']*1000:.2f} ms")
+            print(f"  Min pipelined latency: {stats['min_query_time']*1000:.2f} ms")
+            print(f"  Max pipelined latency: {stats['max_query_time']*1000:.2f} ms")
+            print(f"  P95 pipelined latency: {stats['p95_query_time']*1000:.2f} ms")
             print(f"  Avg result count: {stats['avg_result_count']:.1f} rows")
             print("-" * 80)
         
@@ -170,7 +207,8 @@ class PostgreSQLBenchmark:
         print("BENCHMARK SUMMARY")
         print("=" * 80)
         
-        print(f"{'Concurrency':<12} {'QPS':<10} {'Avg Time':<12} {'Min Time':<12} {'Max Time':<12} {'P95 Time':<12}")
+        print(f"Times are pipelined latencies (ms): submit to window sync, depth {PIPELINE_DEPTH}")
+        print(f"{'Concurrency':<12} {'QPS':<10} {'Avg Sync':<12} {'Min Sync':<12} {'Max Sync':<12} {'P95 Sync':<12}")
         print("-" * 80)
         
         for stats in results:
@@ -182,7 +220,27 @@ class PostgreSQLBenchmark:
         optimal = max(results, key=lambda x: x['queries_per_second'])
         print("\nOptimal concurrency: ", optimal['concurrency'])
         print(f"Maximum throughput: {optimal['queries_per_second']:.2f} queries per second")
-        print(f"Average query time at optimal concurrency: {optimal['avg_query_time']*1000:.2f} ms")
+        print(f"Average pipelined latency at optimal concurrency: {optimal['avg_query_time']*1000:.2f} ms")
+
+async def run(benchmark, args):
+    """Check connectivity, then run the escalating benchmark"""
+    # Test connection (opening the pool waits for all of its connections)
+    print("Testing database connection...")
+    await benchmark.pool.open(wait=True)
+    print("Connection successful!")
+    
+    try:
+        await benchmark.choose_query()
+        print(f"Query: {' '.join(benchmark.query.split())}")
+        
+        # Run benchmark
+        return await benchmark.run_escalating_benchmark(
+            max_concurrency=args.max_concurrency,
+            step_size=args.step_size,
+            duration_per_step=args.duration
+        )
+    finally:
+        await benchmark.pool.close()
 
 def main():
     parser = argparse.ArgumentParser(description='PostgreSQL Query Performance Benchmark')
@@ -207,23 +265,18 @@ def main():
     
     print(f"PostgreSQL Query Performance Benchmark - {datetime.now()}")
     print(f"Database: {db_config['database']} on {db_config['host']}:{db_config['port']}")
-    print(f"Query: SELECT element, MAX(tsver) as max_tsver FROM map WHERE tile = ? AND tsver <= ? GROUP BY element")
     
     try:
-        benchmark = PostgreSQLBenchmark(db_config)
-        
-        # Test connection
-        print("Testing database connection...")
-        conn = benchmark.create_connection()
-        conn.close()
-        print("Connection successful!")
+        benchmark = PostgreSQLBenchmark(db_config, args.max_concurrency)
         
-        # Run benchmark
-        results = benchmark.run_escalating_benchmark(
-            max_concurrency=args.max_concurrency,
-            step_size=args.step_size,
-            duration_per_step=args.duration
-        )
+        # uvloop when available, otherwise the default asyncio loop; uvloop.run only
+        # exists from uvloop 0.18, older releases install their loop policy instead
+        run_loop = getattr(uvloop, 'run', None)
+        if run_loop is None:
+            if uvloop:
+                uvloop.install()
+            run_loop = asyncio.run
+        results = run_loop(run(benchmark, args))
         
         # Print summary
         benchmark.print_summary(results)
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 #-*-coding: utf-8-*-
 
 # Script Description:
@@ -11,10 +11,9 @@ import os
 import os.path
 import time
 import logging
-import commands
-import glob
-import random
-import string
+import subprocess
+import threading
+import re
 import traceback
 
 # -----------------------------------------------------------------------------------------------------
@@ -49,7 +48,7 @@ class Logger:
     def info(self,message):
         self.logger.info(message)
     def war(self,message):
-        self.logger.warn(message)
+        self.logger.warning(message)
     def error(self,message):
         self.logger.error(message)
 
@@ -73,7 +72,15 @@ tableNum = 250
 tableSize = 25000
 combo = ['oltp_read_write','oltp_read_only','oltp_write_only']
 #combo = ['oltp_read_write']
-outputFile = './result_sysbench_mysql.{}.csv'.format(time.strftime("%Y%m%d%H%M", time.localtime()))
+# Test all clusters at once, one thread each. Off by default: the parallel sysbench clients
+# share this host's CPU and can skew each other's results
+parallelClusters = False
+outputFile = f'./result_sysbench_mysql.{time.strftime("%Y%m%d%H%M", time.localtime())}.csv'
+
+# sysbench report lines, e.g. "transactions: 12345 (411.46 per sec.)" / "95th percentile: 58.92"
+TPS_RE = re.compile(r'transactions:\s*\d+\s*\(([\d.]+) per sec')
+QPS_RE = re.compile(r'queries:\s*\d+\s*\(([\d.]+) per sec')
+P95_RE = re.compile(r'95th percentile:\s*([\d.]+)')
 
 #-----------------------------------------------------------------------------------------------------
 # Functions
@@ -81,39 +88,39 @@ outputFile = './result_sysbench_mysql.{}.csv'.format(time.strftime("%Y%m%d%H%M",
 def sysbench_test():
     #create database and prepare data
     for cluster in clusterList:
-        LoggerPrint.info("Prepare data for {}".format(cluster['endpoint']))
+        LoggerPrint.info(f"Prepare data for {cluster['endpoint']}")
 
         # create database
-        createDBCommand = "mysql -h{} -P{} -u{} -p{} -e 'drop database if exists {}; create database {} ;'".format(cluster['endpoint'],mysqlPort,mysqlUser,mysqlPassword,dbName,dbName)
-        (commandStatus, commandOutput) = commands.getstatusoutput(createDBCommand)
+        createDBCommand = f"mysql -h{cluster['endpoint']} -P{mysqlPort} -u{mysqlUser} -p{mysqlPassword} -e 'drop database if exists {dbName}; create database {dbName} ;'"
+        (commandStatus, commandOutput) = subprocess.getstatusoutput(createDBCommand)
         #LoggerPrint.error(createDBCommand)
         if commandStatus != 0 or  "FATAL:" in commandOutput:
-            LoggerPrint.error("Failed to create database by command: {}".format(createDBCommand))
+            LoggerPrint.error(f"Failed to create database by command: {createDBCommand}")
             LoggerPrint.error(commandOutput)
             sys.exit(1)
 
         # check parameter
         sql = "show variables like 'log_bin'; show variables like 'sync_binlog'; show variables like 'innodb_flush_log_at_trx_commit';"
-        checkParCommand = 'mysql -N -s -h{} -P{} -u{} -p{} -e "{}"'.format(cluster['endpoint'],mysqlPort,mysqlUser,mysqlPassword,sql)
-        (commandStatus, commandOutput) = commands.getstatusoutput(checkParCommand)
+        checkParCommand = f'mysql -N -s -h{cluster["endpoint"]} -P{mysqlPort} -u{mysqlUser} -p{mysqlPassword} -e "{sql}"'
+        (commandStatus, commandOutput) = subprocess.getstatusoutput(checkParCommand)
         LoggerPrint.info(commandOutput.replace('mysql: [Warning] Using a password on the command line interface can be insecure.','Key parameters:'))
         if commandStatus != 0 or  "FATAL:" in commandOutput:
-            LoggerPrint.error("Failed to check parameter by command: {}".format(checkParCommand))
+            LoggerPrint.error(f"Failed to check parameter by command: {checkParCommand}")
             sys.exit(1)
 
         # load data
-        prepareCommand = '''sysbench \
-                            --mysql-host={} \
-                            --mysql-port={} \
-                            --mysql-db={} \
-                            --mysql-user={} \
-                            --mysql-password={} \
-                            --table_size={} \
-                            --tables={} \
+        prepareCommand = f'''sysbench \
+                            --mysql-host={cluster['endpoint']} \
+                            --mysql-port={mysqlPort} \
+                            --mysql-db={dbName} \
+                            --mysql-user={mysqlUser} \
+                            --mysql-password={mysqlPassword} \
+                            --table_size={tableSize} \
+                            --tables={tableNum} \
                             --threads=16 \
                             oltp_read_write \
-                            prepare'''.format(cluster['endpoint'],mysqlPort,dbName,mysqlUser,mysqlPassword,tableSize,tableNum)
-        (commandStatus, commandOutput) = commands.getstatusoutput(prepareCommand)
+                            prepare'''
+        (commandStatus, commandOutput) = subprocess.getstatusoutput(prepareCommand)
         if commandStatus != 0 or  "FATAL:" in commandOutput:
             LoggerPrint.error(prepareCommand)
             LoggerPrint.error(commandOutput)
@@ -123,64 +130,100 @@ def sysbench_test():
     f = open(outputFile, 'w+')
     fileHeader = 'Version,Size,Scenario,Metrics'
     for thread in threadList:
-        colName = ',thread-{}'.format(thread)
+        colName = f',thread-{thread}'
         fileHeader+= colName
     f.write(fileHeader)
-    for cluster in clusterList:
-        for scenario in combo:
-            lineHeader = '\n{},{},{}'.format(cluster['version'], cluster['size'], scenario)
-            lineQueries = '{},QPS'.format(lineHeader)
-            lineTrans = '{},TPS'.format(lineHeader)
-            lineLatency = '{},Latency/ms'.format(lineHeader)
-            for threads in threadList:
-                try :
-                    LoggerPrint.info("-"*120)
-                    LoggerPrint.info("Running test: version {} | size {} | scenario {} | threads {} ".format(cluster['version'],cluster['size'],scenario,threads))
-                    testCommand = '''sysbench \
-                                    --mysql-host={} \
-                                    --mysql-port={} \
-                                    --mysql-db={} \
-                                    --mysql-user={} \
-                                    --mysql-password={} \
-                                    --table_size={} \
-                                    --tables={} \
-                                    --threads={} \
-                                    --db-ps-mode=disable \
-                                    --time=300 \
-                                    --report-interval=30 \
-                                    --percentile=95 \
-                                    --rand-type=uniform \
-                                    --mysql-ignore-errors=1062 \
-                                    --skip-trx=1 \
-                                    --range_selects=0 \
-                                    {} run '''.format(cluster['endpoint'],mysqlPort,dbName,mysqlUser,mysqlPassword,tableSize,tableNum,threads,scenario)
-
-                    #LoggerPrint.info(testCommand)
-                    (commandStatus, commandOutput) = commands.getstatusoutput(testCommand)
-                    LoggerPrint.info(commandOutput)
-                    rowList = commandOutput.split('\n')
-                    #res = {'scenario':scenario,'thread':threads,  'qps':0, 'tps':0, 'Latency':''}
-                    for row in rowList:
-                        #LoggerPrint.info('-->{}'.format(row))
-                        if 'transactions:' in row:
-                            tps = int(row.split('(')[1].strip(' per sec.)').split('.')[0])
-                            LoggerPrint.info('tps: {}'.format(tps))
-                            lineTrans += ',{}'.format(tps)
-                        elif 'queries:' in row:
-                            qps = int(row.split('(')[1].strip(' per sec.)').split('.')[0])
-                            LoggerPrint.info('qps: {}'.format(qps))
-                            lineQueries += ',{}'.format(qps)
-                        elif '95th percentile:' in row:
-                            Latency = int(float(row.split(':')[-1].replace(' ','')))
-                            lineLatency += ',{}'.format(Latency)
-                    #LoggerPrint.info(res)
-                    time.sleep(60)
-                except Exception,e:
-                    LoggerPrint.error('{0}'.format(traceback.print_exc()))
-                    exit(0)
-            f.write(lineQueries)
-            f.write(lineTrans)
-            f.write(lineLatency)
+    f.flush()
+    fileLock = threading.Lock()
+    if parallelClusters:
+        workers = [threading.Thread(target=cluster_test, args=(cluster, f, fileLock)) for cluster in clusterList]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        for cluster in clusterList:
+            cluster_test(cluster, f, fileLock)
+    f.close()
+
+def run_sysbench(testCommand, tag):
+    # stream sysbench output and parse each line as it arrives instead of buffering the whole run
+    tpsList, qpsList, latencyList = [], [], []
+    proc = subprocess.Popen(testCommand, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for row in iter(proc.stdout.readline, ''):
+        LoggerPrint.info(f"[{tag}] {row.rstrip()}")
+        m = TPS_RE.search(row)
+        if m:
+            tpsList.append(int(float(m.group(1))))
+            continue
+        m = QPS_RE.search(row)
+        if m:
+            qpsList.append(int(float(m.group(1))))
+            continue
+        m = P95_RE.search(row)
+        if m:
+            latencyList.append(int(float(m.group(1))))
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f"sysbench exited with status {proc.returncode}: {testCommand}")
+    return tpsList, qpsList, latencyList
+
+def write_lines(f, fileLock, lines):
+    # write a finished scenario right away so a killed run keeps what it measured
+    with fileLock:
+        for line in lines:
+            f.write(line)
+        f.flush()
+
+def cluster_test(cluster, f, fileLock):
+    tag = cluster['version']
+    for scenario in combo:
+        lineHeader = f"\n{cluster['version']},{cluster['size']},{scenario}"
+        lineQueries = f'{lineHeader},QPS'
+        lineTrans = f'{lineHeader},TPS'
+        lineLatency = f'{lineHeader},Latency/ms'
+        for threads in threadList:
+            try :
+                LoggerPrint.info(f"[{tag}] " + "-"*120)
+                LoggerPrint.info(f"[{tag}] Running test: version {cluster['version']} | size {cluster['size']} | scenario {scenario} | threads {threads} ")
+                testCommand = f'''sysbench \
+                                --mysql-host={cluster['endpoint']} \
+                                --mysql-port={mysqlPort} \
+                                --mysql-db={dbName} \
+                                --mysql-user={mysqlUser} \
+                                --mysql-password={mysqlPassword} \
+                                --table_size={tableSize} \
+                                --tables={tableNum} \
+                                --threads={threads} \
+                                --db-ps-mode=disable \
+                                --time=300 \
+                                --report-interval=30 \
+                                --percentile=95 \
+                                --rand-type=uniform \
+                                --mysql-ignore-errors=1062 \
+                                --skip-trx=1 \
+                                --range_selects=0 \
+                                {scenario} run '''
+
+                #LoggerPrint.info(testCommand)
+                (tpsList, qpsList, latencyList) = run_sysbench(testCommand, tag)
+                #res = {'scenario':scenario,'thread':threads,  'qps':0, 'tps':0, 'Latency':''}
+                for tps in tpsList:
+                    LoggerPrint.info(f'[{tag}] tps: {tps}')
+                    lineTrans += f',{tps}'
+                for qps in qpsList:
+                    LoggerPrint.info(f'[{tag}] qps: {qps}')
+                    lineQueries += f',{qps}'
+                for Latency in latencyList:
+                    lineLatency += f',{Latency}'
+                #LoggerPrint.info(res)
+                time.sleep(60)
+            except Exception:
+                # keep this scenario's partial results, then stop testing this cluster
+                LoggerPrint.error(f"[{tag}] {traceback.format_exc()}")
+                write_lines(f, fileLock, (lineQueries, lineTrans, lineLatency))
+                return
+        write_lines(f, fileLock, (lineQueries, lineTrans, lineLatency))
 
 # -----------------------------------------------------------------------------------------------------
 # Main
@@ -194,10 +237,10 @@ if __name__ == '__main__':
     try:
         LoggerPrint.info('Start script.')
         main()
-        LoggerPrint.info('Output File: {}'.format(outputFile))
+        LoggerPrint.info(f'Output File: {outputFile}')
         LoggerPrint.info('Script complted successfully.')
         sys.exit(0)
-    except Exception,e:
+    except Exception:
         errMsg = "Error found!"
         LoggerPrint.error(errMsg)
-        LoggerPrint.error('{}'.format(traceback.format_exc()))
+        LoggerPrint.error(traceback.format_exc())